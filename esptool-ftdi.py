@@ -24,11 +24,71 @@ class ftdi_context_partial(ctypes.Structure):
     _fields_ = [('libusb_context', ctypes.c_void_p),
                 ('libusb_device_handle', ctypes.c_void_p),
                 ('usb_read_timeout', ctypes.c_int),
-                ('usb_write_timeout', ctypes.c_int)]
+                ('usb_write_timeout', ctypes.c_int),
+                ('type', ctypes.c_int),
+                ('baudrate', ctypes.c_int),
+                ('bitbang_enabled', ctypes.c_ubyte),
+                ('readbuffer', ctypes.c_void_p),
+                ('readbuffer_offset', ctypes.c_uint),
+                ('readbuffer_remaining', ctypes.c_uint),
+                ('readbuffer_chunksize', ctypes.c_uint),
+                ('writebuffer_chunksize', ctypes.c_uint),
+                ('max_packet_size', ctypes.c_uint),
+                ('interface', ctypes.c_int),
+                ('index', ctypes.c_int),
+                ('in_ep', ctypes.c_int),
+                ('out_ep', ctypes.c_int)]
 
 class FTDIError(Exception):
     pass
 
+LIBUSB_ERROR_TIMEOUT = -7
+
+# (devnum path, (busnum, devnum, interface)) found for each char
+# device, by st_rdev
+_port_cache = {}
+
+# Size of our libusb read transfers (and scratch buffer), and of
+# libftdi's write chunks.  A multiple of the FTDI packet size, so every
+# received packet fits whole.
+USB_CHUNKSIZE = 65536
+
+@functools.lru_cache(None)
+def load_libs():
+    # Load libftdi and libusb once per process, since find_library can
+    # be slow, and declare prototypes for everything we call with
+    # arguments.
+    def load_lib(name):
+        libname = ctypes.util.find_library(name)
+        if not libname:
+            raise Exception("Can't find library " + name)
+        return ctypes.CDLL(libname)
+    usb = load_lib('usb-1.0')
+    ftdi = load_lib('ftdi1')
+
+    usb.libusb_error_name.restype = ctypes.c_char_p
+    usb.libusb_bulk_transfer.argtypes = [
+        ctypes.c_void_p, ctypes.c_ubyte, ctypes.c_void_p, ctypes.c_int,
+        ctypes.POINTER(ctypes.c_int), ctypes.c_uint]
+    usb.libusb_bulk_transfer.restype = ctypes.c_int
+
+    ftdi.ftdi_get_error_string.restype = ctypes.c_char_p
+    ctx_p = ctypes.c_void_p
+    u8 = ctypes.c_ubyte
+    for (fn, argtypes) in (
+            ('ftdi_write_data', [ctx_p, ctypes.c_void_p, ctypes.c_int]),
+            ('ftdi_set_bitmode', [ctx_p, u8, u8]),
+            ('ftdi_setrts', [ctx_p, ctypes.c_int]),
+            ('ftdi_setflowctrl', [ctx_p, ctypes.c_int]),
+            ('ftdi_usb_purge_rx_buffer', [ctx_p]),
+            ('ftdi_usb_purge_tx_buffer', [ctx_p]),
+            ('ftdi_set_baudrate', [ctx_p, ctypes.c_int]),
+            ('ftdi_set_latency_timer', [ctx_p, u8]),
+            ('ftdi_get_latency_timer', [ctx_p, ctypes.POINTER(u8)])):
+        getattr(ftdi, fn).argtypes = argtypes
+        getattr(ftdi, fn).restype = ctypes.c_int
+    return (usb, ftdi)
+
 class serial_via_libftdi(object):
     @staticmethod
     def serial_for_url(port):
@@ -49,9 +109,7 @@ class serial_via_libftdi(object):
     def _ftdi_close(self):
         if getattr(self, 'cleanup_close', False):
             #printf("reattaching and closing\n")
-            context = ctypes.cast(ctypes.byref(self.ctx),
-                                  ctypes.POINTER(ftdi_context_partial)).contents
-            pdev = ctypes.c_void_p(context.libusb_device_handle)
+            pdev = ctypes.c_void_p(self._ctx_struct.libusb_device_handle)
             if pdev:
                 self.usb.libusb_release_interface(pdev, self.interface)
                 self.usb.libusb_attach_kernel_driver(pdev, self.interface)
@@ -64,27 +122,39 @@ class serial_via_libftdi(object):
     def _find_port_linux(self, port):
         # Find the port
         s = os.stat(port)
+        if s.st_rdev in _port_cache:
+            # The tty may have been reused by a replugged device with a
+            # new devnum, so only trust the cache if devnum still matches.
+            (devnum_path, found) = _port_cache.pop(s.st_rdev)
+            try:
+                with open(os.path.join(devnum_path, "devnum")) as f:
+                    if int(f.read()) == found[1]:
+                        _port_cache[s.st_rdev] = (devnum_path, found)
+                        return found
+            except (IOError, ValueError):
+                pass
         path = "/sys/dev/char/%d:%d" % (
             os.major(s.st_rdev), os.minor(s.st_rdev))
         path = os.path.realpath(path)
 
-        # Walk up the tree until we find interface, busnum, and devnum files
-        def try_read(path, filename, converter):
-            p = os.path.join(path, filename)
-            try:
-                with open(p) as f:
-                    return converter(f.read())
-            except IOError:
+        # Walk up the tree until we find interface, busnum, and devnum files.
+        # List each directory once rather than probing for every file.
+        def try_read(path, names, filename, converter):
+            if filename not in names:
                 return None
+            with open(os.path.join(path, filename)) as f:
+                return converter(f.read())
 
         (busnum, devnum, interface) = (None, None, None)
         while path != "/":
+            names = set(os.listdir(path))
             if busnum is None:
-                busnum = try_read(path, "busnum", int)
+                busnum = try_read(path, names, "busnum", int)
             if devnum is None:
-                devnum = try_read(path, "devnum", int)
+                devnum = try_read(path, names, "devnum", int)
+                devnum_path = path
             if interface is None:
-                interface = try_read(path, "bInterfaceNumber",
+                interface = try_read(path, names, "bInterfaceNumber",
                                      lambda x: int(x, 16))
             if None not in (busnum, devnum, interface):
                 break
@@ -93,6 +163,7 @@ class serial_via_libftdi(object):
             raise Exception("can't find bus/device/interface for that port")
         printf("%s is at bus %d dev %d interface %d\n", port, busnum,
                devnum, interface)
+        _port_cache[s.st_rdev] = (devnum_path, (busnum, devnum, interface))
         return (busnum, devnum, interface)
 
     def _find_port_libusb(self, port):
@@ -118,16 +189,24 @@ class serial_via_libftdi(object):
         self.dtr = False
         self.rts = False
         self.bitmode = False
-
-        # Load libftdi and libusb
-        def load_lib(name):
-            libname = ctypes.util.find_library(name)
-            if not libname:
-                raise Exception("Can't find library " + name)
-            return ctypes.CDLL(libname)
-        self.usb = load_lib('usb-1.0')
-        self.ftdi = load_lib('ftdi1')
-        self.ftdi.ftdi_get_error_string.restype = ctypes.c_char_p
+        self._bitbang_val = None
+        self._rxbuf = bytearray()
+        self._rx_scratch = ctypes.create_string_buffer(USB_CHUNKSIZE)
+        self._rx_view = memoryview(self._rx_scratch)
+        self._ctrl_buf = (ctypes.c_ubyte * 1)()
+
+        # Load libftdi and libusb, and keep direct references to the
+        # functions used on hot paths, to avoid going through ftdi_fn
+        # on every read, write, and control change.
+        (self.usb, self.ftdi) = load_libs()
+        self._bulk_transfer = self.usb.libusb_bulk_transfer
+        self._transferred = ctypes.c_int()
+        self._write = self.ftdi.ftdi_write_data
+        self._set_bitmode = self.ftdi.ftdi_set_bitmode
+        self._setrts = self.ftdi.ftdi_setrts
+        self._setflowctrl = self.ftdi.ftdi_setflowctrl
+        self._purge_rx = self.ftdi.ftdi_usb_purge_rx_buffer
+        self._purge_tx = self.ftdi.ftdi_usb_purge_tx_buffer
 
         # Find port
         print('Searching for port %s' % port)
@@ -140,8 +219,11 @@ class serial_via_libftdi(object):
               (busnum, devnum, self.interface))
 
         # Open it via libftdi
+        self.ctx = ctypes.create_string_buffer(1024)
+        self._ctx_ref = ctypes.byref(self.ctx)
+        self._ctx_struct = ctypes.cast(
+            self._ctx_ref, ctypes.POINTER(ftdi_context_partial)).contents
         try:
-            self.ctx = ctypes.create_string_buffer(1024)
             if self.ftdi_fn.ftdi_init() != 0:
                 raise FTDIError("ftdi_init")
             self.cleanup_deinit = True
@@ -150,8 +232,20 @@ class serial_via_libftdi(object):
             if self.ftdi_fn.ftdi_usb_open_bus_addr(busnum, devnum) != 0:
                 raise FTDIError("usb_open_bus_addr")
             self.cleanup_close = True
+            if self.ftdi_fn.ftdi_write_data_set_chunksize(USB_CHUNKSIZE) != 0:
+                raise FTDIError("ftdi_write_data_set_chunksize")
+            # Default latency timer is 16ms, which makes every small
+            # read wait that long before the chip sends a USB packet.
+            if self.ftdi_fn.ftdi_set_latency_timer(1) != 0:
+                raise FTDIError("ftdi_set_latency_timer")
             self.ftdi_fn.ftdi_set_bitmode(0, 0)
             self.ftdi_fn.ftdi_setrts(0)
+            # Reads bypass libftdi and go straight to libusb
+            self._usb_dev = self._ctx_struct.libusb_device_handle
+            # libftdi names endpoints from the chip's point of view:
+            # its out_ep (e.g. 0x81) is the one the host reads from.
+            self._read_ep = self._ctx_struct.out_ep
+            self._max_packet_size = self._ctx_struct.max_packet_size
             print("FTDI configured")
         except FTDIError as e:
             self._ftdi_error(str(e))
@@ -175,19 +269,29 @@ class serial_via_libftdi(object):
         if (self.dtr, self.rts) == (False, False):
             # Normal mode
             if self.bitmode:
-                self.write("%c" % val)
+                self._write_control(val)
                 self.flushOutput()
-                self.ftdi_fn.ftdi_set_bitmode(0, 0)
-                self.ftdi_fn.ftdi_setflowctrl(0)
-                self.ftdi_fn.ftdi_setrts(0)
+                self._set_bitmode(self._ctx_ref, 0, 0)
+                self._setflowctrl(self._ctx_ref, 0)
+                self._setrts(self._ctx_ref, 0)
             self.bitmode = False
             return
 
-        # Bitbang mode
+        # Bitbang mode.  Nothing to do if we already wrote this value.
+        if self.bitmode and val == self._bitbang_val:
+            return
         if not self.bitmode:
-            self.ftdi_fn.ftdi_set_bitmode(0x0d, 0x01)
+            self._bitbang_val = None
+            self._set_bitmode(self._ctx_ref, 0x0d, 0x01)
         self.bitmode = True
-        self.write("%c" % val)
+        self._write_control(val)
+        self._bitbang_val = val
+
+    def _write_control(self, val):
+        # Write a single bitbang byte from a preallocated buffer
+        self._ctrl_buf[0] = val
+        if self._write(self._ctx_ref, self._ctrl_buf, 1) < 0:
+            self._ftdi_error("ftdi_write_data")
 
     def setDTR(self, active):
         self.dtr = active
@@ -198,26 +302,35 @@ class serial_via_libftdi(object):
         self._ftdi_update_control()
 
     def flushInput(self):
-        self.ftdi_fn.ftdi_usb_purge_rx_buffer()
+        self._purge_rx(self._ctx_ref)
+        del self._rxbuf[:]
     reset_input_buffer = flushInput
 
     def flushOutput(self):
-        self.ftdi_fn.ftdi_usb_purge_tx_buffer()
+        self._purge_tx(self._ctx_ref)
 
     @property
     def timeout(self):
-        context = ctypes.cast(ctypes.byref(self.ctx),
-                              ctypes.POINTER(ftdi_context_partial))
-        return context[0].usb_read_timeout / 1000.0
+        return self._ctx_struct.usb_read_timeout / 1000.0
 
     @timeout.setter
     def timeout(self, new_timeout):
-        context = ctypes.cast(ctypes.byref(self.ctx),
-                              ctypes.POINTER(ftdi_context_partial))
-        context[0].usb_read_timeout = int(new_timeout * 1000)
-        context[0].usb_write_timeout = int(new_timeout * 1000)
+        self._ctx_struct.usb_read_timeout = int(new_timeout * 1000)
+        self._ctx_struct.usb_write_timeout = int(new_timeout * 1000)
         self._timeout = new_timeout
 
+    @property
+    def latency_timer(self):
+        latency = ctypes.c_ubyte()
+        if self.ftdi_fn.ftdi_get_latency_timer(ctypes.byref(latency)) != 0:
+            self._ftdi_error("ftdi_get_latency_timer")
+        return latency.value
+
+    @latency_timer.setter
+    def latency_timer(self, val):
+        if self.ftdi_fn.ftdi_set_latency_timer(val) != 0:
+            self._ftdi_error("ftdi_set_latency_timer")
+
     @property
     def baudrate(self):
         return self._baudrate
@@ -229,37 +342,61 @@ class serial_via_libftdi(object):
         self._baudrate = val;
 
     def write(self, buf):
-        try:
+        if isinstance(buf, bytes):
+            bytesbuf = buf
+        elif isinstance(buf, (bytearray, memoryview)):
             bytesbuf = bytes(buf)
-        except TypeError:
+        else:
             bytesbuf = buf.encode('latin1')
-        data = ctypes.create_string_buffer(bytesbuf)
-        written = self.ftdi_fn.ftdi_write_data(ctypes.byref(data), len(buf))
+        # ctypes passes the bytes object's own storage, so no copy is made
+        written = self._write(self._ctx_ref, bytesbuf, len(bytesbuf))
         if written < 0:
             self._ftdi_error("ftdi_write_data")
         #printf("> %d %d '%02x'\n", len(buf), written, ord(buf[0]))
         return written
 
-    def inWaiting(self):
-        # If we always return 0, esptool will just read 1 byte at a time
-        return 0
+    def _fill_rxbuf(self):
+        # Do one bulk transfer directly via libusb and append the
+        # received data to our buffer.  The chip sends a packet at
+        # least every latency timer period, so this returns quickly
+        # even if there's no data.  A timeout of 0 means "wait forever"
+        # to libusb, so never pass less than 1 ms.
+        ret = self._bulk_transfer(self._usb_dev, self._read_ep,
+                                  self._rx_scratch, len(self._rx_scratch),
+                                  ctypes.byref(self._transferred),
+                                  max(1, self._ctx_struct.usb_read_timeout))
+        if ret < 0 and ret != LIBUSB_ERROR_TIMEOUT:
+            raise FTDIError("libusb_bulk_transfer: %s" %
+                            self.usb.libusb_error_name(ret))
+
+        # Every USB packet from the chip starts with two modem status
+        # bytes, which libftdi would normally strip for us.  Slicing the
+        # memoryview doesn't copy, so the payload is copied only once.
+        data = self._rx_view[0:self._transferred.value]
+        mps = self._max_packet_size
+        for offset in range(0, len(data), mps):
+            self._rxbuf += data[offset + 2:offset + mps]
 
-    def _read(self, count):
-        buf = ctypes.create_string_buffer(count)
-        rlen = self.ftdi_fn.ftdi_read_data(ctypes.byref(buf), count)
-        if rlen < 0:
-            self._ftdi_error("ftdi_read_data")
-        return buf.raw[0:rlen]
+    def inWaiting(self):
+        # Pull whatever the chip has already sent into our own buffer,
+        # so esptool can read it in one go rather than 1 byte at a time.
+        self._fill_rxbuf()
+        return len(self._rxbuf)
 
     def read(self, count):
-        start = time.time()
-        ret = b''
-        while True:
-            ret += self._read(count - len(ret))
-            if len(ret) >= count:
-                return ret
-            if time.time() - start > self._timeout:
-                return b''
+        # A single transfer can't wait out the whole timeout, because the
+        # chip sends a status-only packet every latency timer period.
+        # Only check the clock when a transfer comes back empty, since
+        # every transfer with data gets us closer to done anyway.
+        deadline = time.time() + self._timeout
+        while len(self._rxbuf) < count:
+            have = len(self._rxbuf)
+            self._fill_rxbuf()
+            if len(self._rxbuf) == have and time.time() > deadline:
+                break
+        ret = bytes(self._rxbuf[0:count])
+        del self._rxbuf[0:count]
+        return ret
 
     def close(self):
         self._ftdi_close()